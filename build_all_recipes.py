@@ -1,8 +1,11 @@
-import os
+import argparse
+import threading
 from pymongo import ASCENDING
 from mongo_singleton import mongo
-from create_recipe import build_package_and_deps
+from create_recipe import build_package_and_deps, mark_failed, reset_logs
 from dependency_lookup import UnknownDependency
+import releases
+import error_fixes
 
 # Import and set logger
 import logging
@@ -15,33 +18,64 @@ db = mongo.bioconductor_packages
 packages = db.packages
 dep_lookup = db.dependency_lookup
 
-# Reset log files
-try:
-    os.remove("stderr.txt")
-except OSError:
-    pass
-try:
-    os.remove("stdout.txt")
-except OSError:
-    pass
+
+# Names of the packages which a worker has picked up.
+claimed = set()
+claimed_lock = threading.Lock()
 
 
 def get_next_package():
-    return packages.find({"state": {"$eq": "NEW"}}).sort("priority", ASCENDING).next()
+    with claimed_lock:
+        query = {"state": {"$eq": "NEW"},
+                 "release": {"$in": [releases.current_release, None]},
+                 "name": {"$nin": list(claimed)}}
+        package = packages.find_one(query, sort=[("priority", ASCENDING)])
+        if package is not None:
+            claimed.add(package["name"])
+        return package
 
 
-package_to_build = get_next_package()
+def build_worker():
+    package_to_build = get_next_package()
 
-while(True):
-    try:
-        last_build_success = build_package_and_deps(package_to_build["name"])
-    except UnknownDependency as e:
-        message = e.args
-        packages.update_one(
-            {"name": package_to_build["name"]},
-            {"$set": {"state": "FAILED"}}
-        )
-        logger.info(("The last build command raised an UnknownDependency error for the"
-                     " dependency: {}").format(message))
+    while package_to_build is not None:
+        try:
+            build_package_and_deps(package_to_build["name"])
+        except UnknownDependency as e:
+            message = e.args
+            mark_failed(package_to_build["name"], "unknown_dependency",
+                        failure_message=str(message))
+            logger.info(("The last build command raised an UnknownDependency error for the"
+                         " dependency: {}").format(message))
 
-    package_to_build = get_next_package()
+        package_to_build = get_next_package()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Builds every package which hasn\'t been built yet.')
+    parser.add_argument(
+        '-r', '--release', default=releases.DEFAULT_RELEASE,
+        help='The bioconductor release to build packages for.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help=('The most packages to build at once. Builds only start when there are'
+              ' enough free cores and memory for them.'))
+
+    args = vars(parser.parse_args())
+    releases.set_current_release(args["release"])
+    releases.ensure_indexes()
+    releases.ensure_release_field()
+    error_fixes.ensure_indexes()
+
+    reset_logs()
+
+    workers = [threading.Thread(target=build_worker) for _ in range(args["jobs"])]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
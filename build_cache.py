@@ -0,0 +1,71 @@
+"""In-process caches for values which are expensive to recompute on every build.
+
+A single `python create_recipe.py` run barely benefits from these, but the
+long-running build daemon keeps them warm between requests. Entries expire
+after a TTL, and can also be dropped early with `invalidate_all`."""
+import time
+import threading
+
+DEFAULT_TTL = 300  # seconds
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return default
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# The set of channels passed to `conda build`, keyed by None.
+channels = TTLCache()
+# R package name -> conda package name, as resolved by dependency_lookup.
+dependency_names = TTLCache()
+# R package name -> the fields of its package record needed to resolve it.
+package_records = TTLCache()
+
+ALL_CACHES = {
+    "channels": channels,
+    "dependency_names": dependency_names,
+    "package_records": package_records,
+}
+
+
+def set_ttl(ttl):
+    for cache in ALL_CACHES.values():
+        cache.ttl = ttl
+
+
+def invalidate_all():
+    for cache in ALL_CACHES.values():
+        cache.clear()
+
+
+def sizes():
+    return {name: len(cache) for name, cache in ALL_CACHES.items()}
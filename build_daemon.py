@@ -0,0 +1,217 @@
+"""Runs a long-lived build server so that ad-hoc builds don't pay for a fresh
+interpreter, Mongo connection and cold caches every time.
+
+The server listens on localhost and accepts JSON requests. Build and render
+requests may also give a "release", which defaults to releases.DEFAULT_RELEASE:
+
+    POST /build       {"name": "<package-name>"}   builds a package and its dependencies
+    POST /render      {"name": "<package-name>"}   only writes the package's meta.yaml
+    POST /invalidate                               drops every cached value
+    GET  /status                                   reports cache sizes and uptime
+
+Cached values expire after a TTL. When Mongo supports change streams (i.e. it
+runs as a replica set) the caches are also invalidated as soon as the
+underlying collections change."""
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from pymongo.errors import PyMongoError
+import build_cache
+import releases
+import error_fixes
+from mongo_singleton import mongo
+from create_recipe import build_package_and_deps, render_recipe, reset_logs
+from dependency_lookup import UnknownDependency
+
+# Import and set logger
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PORT = 8765
+
+db = mongo.bioconductor_packages
+packages = db.packages
+dep_lookup = db.dependency_lookup
+
+# Handle one request at a time, since releases.current_release is global.
+build_lock = threading.Lock()
+started_at = time.time()
+
+
+def on_dependency_lookup_change(change):
+    build_cache.channels.clear()
+    build_cache.dependency_names.clear()
+
+
+def on_packages_change(change):
+    # Package documents are updated after every build, but only inserts,
+    # replacements and deletes can change how a dependency resolves.
+    build_cache.package_records.clear()
+    build_cache.dependency_names.clear()
+
+
+def watch_collection(collection, pipeline, callback):
+    try:
+        with collection.watch(pipeline) as stream:
+            for change in stream:
+                callback(change)
+    except PyMongoError as e:
+        logger.warning(("Cannot watch collection %s for changes (%s),"
+                        " relying on cache TTLs instead."), collection.name, e)
+
+
+def start_watchers():
+    watchers = [
+        (dep_lookup, [], on_dependency_lookup_change),
+        (packages,
+         [{"$match": {"operationType": {"$in": ["insert", "replace", "delete"]}}}],
+         on_packages_change),
+    ]
+    for collection, pipeline, callback in watchers:
+        thread = threading.Thread(target=watch_collection,
+                                  args=(collection, pipeline, callback),
+                                  daemon=True)
+        thread.start()
+
+
+def handle_build(request):
+    name = request["name"]
+    with build_lock:
+        releases.set_current_release(request.get("release", releases.DEFAULT_RELEASE))
+        if packages.find_one(releases.package_filter(name), {"_id": 1}) is None:
+            return {"name": name, "error": "Unknown package."}
+
+        # The logs are appended to by every build, only keep this request's.
+        reset_logs()
+        try:
+            success = build_package_and_deps(name)
+        except UnknownDependency as e:
+            logger.info("Building %s raised an UnknownDependency error for: %s", name, e.args)
+            return {"name": name, "success": False, "unknown_dependency": str(e)}
+
+    return {"name": name, "success": success}
+
+
+def handle_render(request):
+    name = request["name"]
+    with build_lock:
+        releases.set_current_release(request.get("release", releases.DEFAULT_RELEASE))
+        package_record = packages.find_one(releases.package_filter(name))
+        if package_record is None:
+            return {"name": name, "error": "Unknown package."}
+
+        full_package_name = render_recipe(package_record)
+
+    return {"name": name, "recipe": "recipes/{}/meta.yaml".format(full_package_name)}
+
+
+def handle_invalidate(request):
+    build_cache.invalidate_all()
+    return {"invalidated": True}
+
+
+def handle_status(request):
+    return {
+        "uptime": time.time() - started_at,
+        "building": build_lock.locked(),
+        "cache_sizes": build_cache.sizes(),
+    }
+
+
+# Endpoint -> (handler, the fields the request must have).
+POST_HANDLERS = {
+    "/build": (handle_build, ["name"]),
+    "/render": (handle_render, ["name"]),
+    "/invalidate": (handle_invalidate, []),
+}
+
+GET_HANDLERS = {
+    "/status": (handle_status, []),
+}
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def dispatch(self, handlers, request):
+        if self.path not in handlers:
+            self.send_json(404, {"error": "Unknown endpoint: " + self.path})
+            return
+
+        handler, required_fields = handlers[self.path]
+        if not isinstance(request, dict):
+            self.send_json(400, {"error": "Request body must be a JSON object."})
+            return
+        missing_fields = [field for field in required_fields if field not in request]
+        if len(missing_fields) > 0:
+            self.send_json(400, {"error": "Missing field: {}".format(", ".join(missing_fields))})
+            return
+
+        try:
+            self.send_json(200, handler(request))
+        except Exception as e:
+            logger.exception("Request to %s failed.", self.path)
+            self.send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        self.dispatch(GET_HANDLERS, {})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        except ValueError:
+            self.send_json(400, {"error": "Request body is not valid JSON."})
+            return
+
+        self.dispatch(POST_HANDLERS, request)
+
+    def log_message(self, format, *args):
+        logger.info(format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs a build server which keeps its caches warm between builds.')
+    parser.add_argument(
+        '-p', '--port', type=int, default=DEFAULT_PORT, help='The port to listen on.')
+    parser.add_argument(
+        '--ttl', type=int, default=build_cache.DEFAULT_TTL,
+        help='How many seconds cached values are kept for.')
+
+    args = vars(parser.parse_args())
+    build_cache.set_ttl(args["ttl"])
+    releases.ensure_indexes()
+    releases.ensure_release_field()
+    error_fixes.ensure_indexes()
+    start_watchers()
+
+    # Only listen locally, there's no authentication.
+    server = ThreadingHTTPServer(("127.0.0.1", args["port"]), BuildRequestHandler)
+    logger.info("Listening on http://127.0.0.1:%d", args["port"])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""Runs `conda build` commands, only starting a build once the machine has
+the cores and memory it's expected to need. Builds start in the order they
+were asked for, unless a later one fits beside the longest waiting build.
+
+Bioconductor builds vary widely: annotation packages just copy data while
+packages with compiled sources can use every core and several GB of RAM.
+The most cores and memory any build of a package has used are recorded on
+its package record, and used to estimate what the next build will need.
+
+Builds which run at the same time can't share a conda-bld root, since they
+would unpack into and clobber the same work dir (see
+https://github.com/conda/conda-build/issues/2024). So each running build
+gets a slot with its own --croot, which is emptied before every build.
+Built packages all go to the usual conda-bld folder through --output-folder,
+so later builds can still depend on them."""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from mongo_singleton import mongo
+from releases import package_filter
+
+# Import and set logger
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Where built packages go, and the local channel builds install them from.
+OUTPUT_FOLDER = "/home/kurt/miniconda3/conda-bld"
+# Each slot's croot is a directory in here.
+CROOTS_DIR = os.path.join(tempfile.gettempdir(), "bioconductor-scraper-croots")
+
+# What a build is assumed to need before it has been built once.
+DEFAULT_ESTIMATE = {"cores": 1.0, "memory_kb": 2 * 1024 * 1024}
+# Data packages have no sources to compile.
+DATA_PACKAGE_ESTIMATE = {"cores": 1.0, "memory_kb": 512 * 1024}
+# Memory which is never handed out to builds.
+MEMORY_HEADROOM_KB = 1024 * 1024
+# How often to recheck free resources while a build is waiting.
+POLL_INTERVAL = 5
+
+db = mongo.bioconductor_packages
+packages = db.packages
+
+
+def read_meminfo():
+    """Returns the total and available memory in kB, or None if /proc/meminfo
+    isn't there to read."""
+    try:
+        with open("/proc/meminfo") as meminfo_file:
+            fields = dict(line.split(":", 1) for line in meminfo_file)
+    except OSError:
+        return None
+
+    # Values look like "16318412 kB".
+    return (int(fields["MemTotal"].split()[0]), int(fields["MemAvailable"].split()[0]))
+
+
+def build_cores(stats):
+    """Returns how many cores a build kept busy on average."""
+    if stats["wall_seconds"] > 0:
+        return max(1.0, stats["cpu_seconds"] / stats["wall_seconds"])
+    return 1.0
+
+
+def estimate_resources(package_name):
+    """Estimates the cores and memory a build of package_name will need
+    from the most its previous builds, in any release, have used."""
+    package_records = list(packages.find({"name": package_name, "build_stats": {"$exists": True}},
+                                         {"build_stats": 1}))
+    if len(package_records) > 0:
+        stats = [package_record["build_stats"] for package_record in package_records]
+        cores = max(s.get("cores", build_cores(s)) for s in stats)
+        memory_kb = max(s["peak_rss_kb"] for s in stats)
+        return {"cores": min(cores, os.cpu_count()), "memory_kb": memory_kb}
+
+    package_record = packages.find_one({"name": package_name}, {"source_url_base": 1})
+    if package_record is not None and "/data/" in package_record.get("source_url_base", ""):
+        return DATA_PACKAGE_ESTIMATE
+
+    return DEFAULT_ESTIMATE
+
+
+def record_build_stats(package_name, stats):
+    """Records the resources a build used. Builds which fail early on a
+    missing dependency use next to nothing, so the cores and peak RSS are
+    the most any build used, not the last build's."""
+    packages.update_one(
+        package_filter(package_name),
+        {"$max": {"build_stats.cores": build_cores(stats),
+                  "build_stats.peak_rss_kb": stats["peak_rss_kb"]},
+         "$set": {"build_stats.cpu_seconds": stats["cpu_seconds"],
+                  "build_stats.wall_seconds": stats["wall_seconds"]}}
+    )
+
+
+def run_and_measure(command):
+    """Runs command and returns its stdout, stderr and resource usage.
+    Popen.communicate would reap the child itself, so the pipes are drained
+    in threads and the child is reaped with wait4 to get its rusage."""
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    output = {}
+
+    def drain(name, pipe):
+        output[name] = pipe.read()
+        pipe.close()
+
+    readers = [threading.Thread(target=drain, args=("stdout", process.stdout)),
+               threading.Thread(target=drain, args=("stderr", process.stderr))]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    stats = {
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "peak_rss_kb": usage.ru_maxrss,  # Linux reports this in kB.
+        "wall_seconds": time.monotonic() - start,
+    }
+    return output["stdout"], output["stderr"], stats
+
+
+class BuildRunner(object):
+    def __init__(self):
+        self._condition = threading.Condition()
+        # Package name -> the resources reserved for its running build.
+        self._running = {}
+        # (package name, estimate) of each waiting build, longest waiting first.
+        self._waiting = []
+        # Slots which are in use by a running build.
+        self._busy_slots = set()
+
+    def _can_admit(self, waiter):
+        package_name, estimate = waiter
+        if package_name in self._running:
+            # Never build the same package twice at once.
+            return False
+
+        oldest = self._waiting[0]
+        if len(self._running) == 0:
+            # Even a build which needs more than the machine has gets to run
+            # alone, once it has waited longest.
+            return waiter is oldest
+
+        reservations = list(self._running.values())
+        if waiter is not oldest:
+            # Hold back what the longest waiting build needs, so that smaller
+            # builds queued after it can't keep it waiting forever.
+            reservations.append(oldest[1])
+
+        reserved_cores = sum(r["cores"] for r in reservations)
+        if estimate["cores"] > os.cpu_count() - reserved_cores:
+            return False
+
+        meminfo = read_meminfo()
+        if meminfo is not None:
+            total_kb, available_kb = meminfo
+            reserved_kb = sum(r["memory_kb"] for r in reservations)
+            # Running builds may not have reached their peak yet.
+            free_kb = min(available_kb, total_kb - reserved_kb) - MEMORY_HEADROOM_KB
+            if estimate["memory_kb"] > free_kb:
+                return False
+
+        return True
+
+    def _take_slot(self):
+        slot = 0
+        while slot in self._busy_slots:
+            slot += 1
+        self._busy_slots.add(slot)
+        return slot
+
+    def run(self, package_name, command):
+        """Runs the conda build command once there are enough free resources
+        for it, in a clean croot of its own, and returns its stdout and
+        stderr as bytes."""
+        estimate = estimate_resources(package_name)
+        waiter = (package_name, estimate)
+        with self._condition:
+            self._waiting.append(waiter)
+            try:
+                while not self._can_admit(waiter):
+                    self._condition.wait(POLL_INTERVAL)
+            finally:
+                self._waiting = [w for w in self._waiting if w is not waiter]
+            self._running[package_name] = estimate
+            slot = self._take_slot()
+            # Another build may be the longest waiting one now.
+            self._condition.notify_all()
+
+        try:
+            croot = os.path.join(CROOTS_DIR, str(slot))
+            shutil.rmtree(croot, ignore_errors=True)
+            os.makedirs(croot)
+            stdout, stderr, stats = run_and_measure(
+                command + ["--croot", croot, "--output-folder", OUTPUT_FOLDER])
+        finally:
+            with self._condition:
+                del self._running[package_name]
+                self._busy_slots.discard(slot)
+                self._condition.notify_all()
+
+        logger.info("Building %s took %.0fs of CPU time over %.0fs with a peak RSS of %d MB.",
+                    package_name, stats["cpu_seconds"], stats["wall_seconds"],
+                    stats["peak_rss_kb"] // 1024)
+        record_build_stats(package_name, stats)
+        return stdout, stderr
+
+
+class PackageClaims(object):
+    """Makes sure that only one worker thread builds a package, or handles its
+    build errors, at a time. Claims are re-entrant, since handling a
+    package's errors ends with building it again."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # Package name -> [the thread which claimed it, how many times].
+        self._owners = {}
+        # Thread -> the package name it is waiting to claim.
+        self._waiting = {}
+
+    def _would_deadlock(self, thread, owner):
+        """Returns True if owner is, through a chain of waiting workers,
+        waiting for a package claimed by thread."""
+        seen = set()
+        while owner is not None and owner not in seen:
+            if owner is thread:
+                return True
+            seen.add(owner)
+            waiting_for = self._waiting.get(owner)
+            if waiting_for is None or waiting_for not in self._owners:
+                return False
+            owner = self._owners[waiting_for][0]
+        return False
+
+    def acquire(self, package_name):
+        """Claims package_name for the current thread, waiting for another
+        worker to release it if needed. Returns (acquired, waited); acquired
+        is False if waiting would deadlock on a dependency cycle."""
+        thread = threading.current_thread()
+        waited = False
+        with self._condition:
+            while True:
+                owner = self._owners.get(package_name)
+                if owner is None:
+                    self._owners[package_name] = [thread, 1]
+                    return True, waited
+                if owner[0] is thread:
+                    owner[1] += 1
+                    return True, waited
+                if self._would_deadlock(thread, owner[0]):
+                    return False, waited
+
+                waited = True
+                self._waiting[thread] = package_name
+                self._condition.wait()
+                del self._waiting[thread]
+
+    def release(self, package_name):
+        with self._condition:
+            owner = self._owners[package_name]
+            owner[1] -= 1
+            if owner[1] == 0:
+                del self._owners[package_name]
+                self._condition.notify_all()
+
+
+runner = BuildRunner()
+claims = PackageClaims()
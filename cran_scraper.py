@@ -1,7 +1,7 @@
 import requests
 from pymongo import DESCENDING
 from mongo_singleton import mongo
-from lxml import etree
+import html_stream
 
 # Import and set logger
 import logging
@@ -20,25 +20,28 @@ def scrape_cran_package(name):
     packages = db.packages
 
     url = CRAN_URL_TEMPLATE.format(name)
-    request = requests.get(url)
+    request = requests.get(url, stream=True)
     if request.status_code != 200:
+        request.close()
         logger.error("Cran returned non-200 status code for package: " + name)
         return False
 
-    html = request.text
-    parsed_html = etree.HTML(html)
-    tables = parsed_html.findall(".//table")
-    paragraphs = parsed_html.findall(".//p")
-
     package_table = {}
-    for table in tables:
-        rows = iter(table)
-        for row in rows:
-            cols = row.getchildren()
-            if cols[0].text == "License:":
-                package_table[cols[0].text] = cols[1].getchildren()[0].text
-            else:
-                package_table[cols[0].text] = cols[1].text
+    summary_text = None
+    seen_paragraph = False
+    with request:
+        for element in html_stream.iter_elements(request, ("tr", "p")):
+            if element.tag == "tr":
+                cols = element.getchildren()
+                if cols[0].text == "License:":
+                    package_table[cols[0].text] = cols[1].getchildren()[0].text
+                else:
+                    package_table[cols[0].text] = cols[1].text
+            elif not seen_paragraph:
+                summary_text = element.text
+                seen_paragraph = True
+
+            html_stream.release(element)
 
     highest_priority_package = packages.find({}).sort("priority", DESCENDING).next()
     priority = highest_priority_package["priority"] + 1
@@ -50,7 +53,7 @@ def scrape_cran_package(name):
         "home_url": url,
         "source_url_base": SOURCE_URL_BASE,
         "license_code": package_table["License:"],
-        "summary": paragraphs[0].text,
+        "summary": summary_text,
         # Everything depends on R.
         "dependencies": [{"name": "r-base", "version": "3.3.2"}],
         "priority": priority,
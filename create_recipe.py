@@ -1,10 +1,15 @@
 import os
 import re
-import shutil
 from mongo_singleton import mongo
 import argparse
-import subprocess
+import threading
+import build_cache
+import error_fixes
+from datetime import datetime
+import releases
+from releases import package_filter
 from recipe_templater import generate_meta_yaml
+from build_runner import runner, claims
 from dependency_lookup import UnknownDependency
 from cran_scraper import scrape_cran_package
 from pprint import pprint
@@ -15,6 +20,55 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def set_package_state(package_name, state):
+    db = mongo.bioconductor_packages
+    packages = db.packages
+
+    packages.update_one(
+        package_filter(package_name),
+        {"$set": {"state": state, "state_changed_at": datetime.utcnow()}}
+    )
+
+
+def mark_failed(package_name, cause, **details):
+    """Sets the state of package_name to FAILED and records why. A package
+    which already failed while its errors were being handled keeps the more
+    specific cause recorded back then."""
+    db = mongo.bioconductor_packages
+    packages = db.packages
+
+    query = package_filter(package_name)
+    query["state"] = {"$ne": "FAILED"}
+    details.update({"state": "FAILED",
+                    "failure_cause": cause,
+                    "state_changed_at": datetime.utcnow()})
+    packages.update_one(query, {"$set": details})
+
+
+def classify_build_error(stderr, stdout):
+    """Returns a short name for the kind of error which made a build fail."""
+    if stderr.find("ERROR: compilation") != -1:
+        return "compilation"
+    if stderr.find("ERROR: this R") != -1:
+        return "r_version"
+    if stderr.find("ERROR: dep") != -1:
+        return "missing_dependency"
+    if stderr.find("ERROR: lazy") != -1:
+        return "lazy_loading"
+    if stdout.find("The following specifications were found to be in conflict:") != -1:
+        return "specification_conflict"
+    if stdout.find("missing in current linux-64 channels:") != -1:
+        return "missing_conda_package"
+    return "other"
+
+
+def first_error_line(stderr):
+    for line in stderr.split("\n"):
+        if line.find("ERROR") != -1:
+            return line.strip()
+    return None
+
+
 def add_dependencies_to_package(package_name, dependencies):
     logger.info("Adding dependencies:")
     pprint(dependencies)
@@ -22,15 +76,17 @@ def add_dependencies_to_package(package_name, dependencies):
     db = mongo.bioconductor_packages
     packages = db.packages
 
-    package_object = packages.find_one({"name": package_name})
+    package_object = packages.find_one(package_filter(package_name))
     package_deps = package_object["dependencies"]
     package_deps += dependencies
 
     packages.update_one(
-        {"name": package_name},
+        package_filter(package_name),
         {"$set": {"dependencies": package_deps}}
     )
 
+    return True
+
 
 def add_or_build_dependencies(package_name, missing_deps):
     """For each dependency in missing_deps: if dependency already exists on package,
@@ -39,11 +95,11 @@ def add_or_build_dependencies(package_name, missing_deps):
     db = mongo.bioconductor_packages
     packages = db.packages
 
-    package_object = packages.find_one({"name": package_name})
+    package_object = packages.find_one(package_filter(package_name))
     existing_deps = package_object["dependencies"]
     dep_objects = []
     for dep in missing_deps:
-        dep_package = packages.find_one({"name": dep["name"]})
+        dep_package = packages.find_one(package_filter(dep["name"]))
         if dep_package is not None and dep_package["state"] == "FAILED":
             logger.error("Dependency %s has failed before, not adding it to %s.",
                          dep["name"],
@@ -66,13 +122,13 @@ def change_dependency_version(package_name, dependency_package, new_version):
     db = mongo.bioconductor_packages
     packages = db.packages
 
-    package_object = packages.find_one({"name": package_name})
+    package_object = packages.find_one(package_filter(package_name))
     package_deps = package_object["dependencies"]
     package_deps = list(filter(lambda d: d["name"] != dependency_package, package_deps))
     package_deps.append({"name": dependency_package, "version": new_version})
 
     packages.update_one(
-        {"name": package_name},
+        package_filter(package_name),
         {"$set": {"dependencies": package_deps}}
     )
 
@@ -100,6 +156,9 @@ def handle_build_errors(package_name, error_message, full_errors):
             pattern = r"  namespace (.*?) (.*?) is already loaded, but >= (.*?) is required"
             line_match = re.match(pattern, line)
             if line_match is not None:
+                error_fixes.propose_fix(package_name, "namespace_already_loaded", package_name,
+                                        line_match.group(1), line_match.group(3),
+                                        error_fixes.DEPENDENCY_SCOPE)
                 return add_dependencies_to_package(package_name,
                                                    [{"name": line_match.group(1),
                                                      "version": line_match.group(3)}])
@@ -107,6 +166,9 @@ def handle_build_errors(package_name, error_message, full_errors):
             pattern = r"Error : package (.*?) (.*?) is loaded, but >= (.*?) is required by .*"
             line_match = re.match(pattern, line)
             if line_match is not None:
+                error_fixes.propose_fix(package_name, "package_already_loaded", package_name,
+                                        line_match.group(1), line_match.group(3),
+                                        error_fixes.DEPENDENCY_SCOPE)
                 return add_dependencies_to_package(package_name,
                                                    [{"name": line_match.group(1),
                                                      "version": line_match.group(3)}])
@@ -114,6 +176,15 @@ def handle_build_errors(package_name, error_message, full_errors):
             pattern = r"Error : package (.*?) (.*?) was found, but >= (.*?) is required by .*"
             line_match = re.match(pattern, line)
             if line_match is not None:
+                package_object = mongo.bioconductor_packages.packages.find_one(
+                    package_filter(package_name))
+                # A dependency which is already listed gets built instead of
+                # bounded, so there's no fix to remember.
+                if not error_fixes.is_listed(package_object["dependencies"],
+                                             line_match.group(1)):
+                    error_fixes.propose_fix(package_name, "package_too_old", package_name,
+                                            line_match.group(1), line_match.group(3),
+                                            error_fixes.DEPENDENCY_SCOPE)
                 return add_or_build_dependencies(package_name,
                                                  [{"name": line_match.group(1),
                                                    "version": line_match.group(3)}])
@@ -157,6 +228,8 @@ def handle_build_errors(package_name, error_message, full_errors):
                 if r_version == "3.4":
                     r_version = "3.4.0"
 
+                error_fixes.propose_fix(package_name, "r_version_too_old", package_name,
+                                        "r-base", r_version, error_fixes.PACKAGE_SCOPE)
                 change_dependency_version(package_name, "r-base", r_version)
                 return True
 
@@ -179,6 +252,8 @@ def handle_build_errors(package_name, error_message, full_errors):
         if r_version == "3.4":
             r_version = "3.4.0"
 
+        error_fixes.propose_fix(package_name, "r_version_too_old", error_match.group(2),
+                                "r-base", r_version, error_fixes.PACKAGE_SCOPE)
         change_dependency_version(error_match.group(2), "r-base", r_version)
         return True
 
@@ -214,8 +289,6 @@ def handle_build_errors(package_name, error_message, full_errors):
 
 
 def build_dependency(package_name, dependency_object):
-    db = mongo.bioconductor_packages
-    packages = db.packages
     dependency_name = dependency_object["name"]
 
     if dependency_object["state"] != "FAILED":
@@ -225,10 +298,7 @@ def build_dependency(package_name, dependency_object):
         logger.error("Dependency %s failed, so %s must fail as well.",
                      dependency_name,
                      package_name)
-        packages.update_one(
-            {"name": package_name},
-            {"$set": {"state": "FAILED"}}
-        )
+        mark_failed(package_name, "dependency_failed", blocked_by=dependency_name)
         return False
 
 
@@ -281,7 +351,8 @@ def handle_stdout_errors(package_name, stdout_string):
                 # bioconductor-dnacopy -> r 3.2.2*
                 # Then we just want to check for "dnacopy", not "dnacopy -> r 3.2.2*"
                 dependency_name_lower = dependency_name_lower.split(" ")[0]
-                dependency_object = packages.find_one({"lower_name": dependency_name_lower})
+                dependency_object = packages.find_one(
+                    package_filter(dependency_name_lower, "lower_name"))
                 if dependency_object is not None:
                     build_dependency(package_name, dependency_object)
                 else:
@@ -289,7 +360,8 @@ def handle_stdout_errors(package_name, stdout_string):
                     raise UnknownDependency(line)
             elif line.find("r-") != -1:
                 dependency_name_lower = line.replace("  - r-", "")
-                dependency_object = packages.find_one({"lower_name": dependency_name_lower})
+                dependency_object = packages.find_one(
+                    package_filter(dependency_name_lower, "lower_name"))
                 if dependency_object is not None:
                     build_dependency(package_name, dependency_object)
                 else:
@@ -298,7 +370,8 @@ def handle_stdout_errors(package_name, stdout_string):
             # Continue supporting cran- named packages until rerunning from beginning
             elif line.find("cran-") != -1:
                 dependency_name_lower = line.replace("  - cran-", "")
-                dependency_object = packages.find_one({"lower_name": dependency_name_lower})
+                dependency_object = packages.find_one(
+                    package_filter(dependency_name_lower, "lower_name"))
                 if dependency_object is not None:
                     build_dependency(package_name, dependency_object)
                 else:
@@ -309,14 +382,14 @@ def handle_stdout_errors(package_name, stdout_string):
                 raise UnknownDependency
 
     elif specification_conflict_line != -1:
-        package_record = packages.find_one({"name": package_name})
+        package_record = packages.find_one(package_filter(package_name))
         if package_record["state"] == "TRIED":
             logger.info(("Already tried to fix this specification"
                          " error for package {}").format(package_name))
-            packages.update_one({"name": package_name}, {"$set": {"state": "FAILED"}})
+            mark_failed(package_name, "specification_conflict")
             return True
         else:
-            packages.update_one({"name": package_name}, {"$set": {"state": "TRIED"}})
+            set_package_state(package_name, "TRIED")
 
         logger.info("Handling specification conflict error.")
         start_index = specification_conflict_line + 1  # don't include the message itself
@@ -334,7 +407,8 @@ def handle_stdout_errors(package_name, stdout_string):
                 dependency_name_lower = dependency_name_lower.replace("  - cran-", "")
                 dependency_name_lower = dependency_name_lower.split(" ")[0]
 
-                dependency_object = packages.find_one({"lower_name": dependency_name_lower})
+                dependency_object = packages.find_one(
+                    package_filter(dependency_name_lower, "lower_name"))
                 if dependency_object is not None:
                     dependency_name = dependency_object["name"]
                     logger.info("Recurring to build dependency: {}".format(dependency_name))
@@ -351,6 +425,7 @@ def catch_and_handle_errors(package_name, stderr, stdout):
     Otherwise handle standard out errors."""
     dependency_error = None
     build_error = False
+    rebuild_succeeded = False
     for line in stderr.split("\n"):
         if (line.find("ERROR: dep") != -1 or line.find("ERROR: lazy") != -1
                 or line.find("ERROR: this") != -1):
@@ -363,14 +438,17 @@ def catch_and_handle_errors(package_name, stderr, stdout):
         if handle_build_errors(package_name, dependency_error, stderr):
             logger.info(("Tried to handle build errors,"
                          " rebuilding package {}.").format(package_name))
-            success = build_package_and_deps(package_name, False)
+            success = build_package_and_deps(package_name)
             logger.info("Rebuilding package {0} returned {1}".format(package_name, success))
             build_error = not success
+            rebuild_succeeded = success
+        # Fixes made while handling the errors are only worth remembering if they worked.
+        error_fixes.settle_fixes(package_name, rebuild_succeeded)
     else:
         if handle_stdout_errors(package_name, stdout):
             logger.info(("Tried to handle stdout errors,"
                          " rebuilding package {}.").format(package_name))
-            success = build_package_and_deps(package_name, False)
+            success = build_package_and_deps(package_name)
             logger.info("Rebuilding package {0} returned {1}".format(package_name, success))
             build_error = not success
 
@@ -378,27 +456,43 @@ def catch_and_handle_errors(package_name, stderr, stdout):
 
 
 def build_channels_string():
+    channels_string = build_cache.channels.get(None)
+    if channels_string is not None:
+        return channels_string
+
     db = mongo.bioconductor_packages
     dep_lookup = db.dependency_lookup
 
-    channels_set = set()
-    for lookup in dep_lookup.find():
-        channels_set.add(lookup["channel"])
+    channels_set = set(dep_lookup.distinct("channel"))
 
     channels_string = ""
     for channel in channels_set:
         channels_string += "-c {} ".format(channel)
 
+    build_cache.channels.set(None, channels_string)
     return channels_string
 
 
 def build_cran_package(name):
     if scrape_cran_package(name):
-        return build_package_and_deps(name, True, "r-")
+        return build_package_and_deps(name, "r-")
     return False
 
 
-def run_conda_build(full_package_name):
+# Builds may run concurrently, don't interleave their logs.
+log_lock = threading.Lock()
+
+
+def reset_logs():
+    with log_lock:
+        for log_file_name in ["stderr.txt", "stdout.txt"]:
+            try:
+                os.remove(log_file_name)
+            except OSError:
+                pass
+
+
+def run_conda_build(name, full_package_name):
     channels_string = build_channels_string()
     build_command = "conda build {channels}recipes/{package_name}".format(
         channels=channels_string,
@@ -406,41 +500,31 @@ def run_conda_build(full_package_name):
     )
     logger.info("Executing build command:")
     logger.info(build_command)
-    process = subprocess.Popen(build_command.split(),
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
+    # The runner gives every build a clean croot of its own, which is also the
+    # workaround for: https://github.com/conda/conda-build/issues/2024
+    stdout, stderr = runner.run(name, build_command.split())
 
     error_string = stderr.decode("utf-8", "ignore")
-    with open("stderr.txt", "a") as stderr_file:
-        stderr_file.write(error_string)
-
     output_string = stdout.decode("utf-8")
-    with open("stdout.txt", "a") as stdout_file:
-        stdout_file.write(output_string)
+    with log_lock:
+        with open("stderr.txt", "a") as stderr_file:
+            stderr_file.write(error_string)
 
-    return (output_string, error_string)
+        with open("stdout.txt", "a") as stdout_file:
+            stdout_file.write(output_string)
 
+    return (output_string, error_string)
 
-def build_package_and_deps(name, destroy_work_dir=True, prefix="bioconductor-"):
-    db = mongo.bioconductor_packages
-    packages = db.packages
-
-    logger.info("Building package {0}.".format(name))
-    package_record = packages.find_one({"name": name})
-
-    # Check for packages that we can't build.
-    if package_record["state"] == "FAILED":
-        logger.info("Can't build package {}, it has failed in the past.".format(name))
-        return False
 
+def render_recipe(package_record, prefix="bioconductor-"):
+    """Writes the meta.yaml for package_record and returns the full conda package name."""
     if "source" in package_record and package_record["source"] == "cran":
         prefix = "r-"
 
     full_package_name = prefix + package_record["lower_name"]
     os.makedirs("recipes/{}".format(full_package_name), exist_ok=True)
 
-    generate_meta_yaml(
+    md5 = generate_meta_yaml(
         package_record["name"],
         package_record["version"],
         package_record["source_url_base"],
@@ -448,56 +532,102 @@ def build_package_and_deps(name, destroy_work_dir=True, prefix="bioconductor-"):
         package_record["license_code"],
         package_record["summary"],
         package_record["dependencies"],
-        prefix
+        prefix,
+        package_record.get("md5")
     )
+    if "md5" not in package_record:
+        releases.share_md5(package_record, md5)
 
-    build_error = False
+    return full_package_name
 
-    # Workaround for: https://github.com/conda/conda-build/issues/2024
-    if destroy_work_dir:
-        logger.info("Destroying the work dir.")
-        shutil.rmtree("/home/kurt/miniconda3/conda-bld/work", ignore_errors=True)
 
-    output_string, error_string = run_conda_build(full_package_name)
+def build_package_and_deps(name, prefix="bioconductor-"):
+    """Builds package name, handling build errors by fixing its dependencies
+    and building those. Only one worker builds a package at a time; one which
+    had to wait for another goes with the result the other one got."""
+    acquired, waited = claims.acquire(name)
+    if not acquired:
+        logger.error(("Package %s is being built by a worker which is waiting for"
+                      " this one, not building it."), name)
+        return False
+
+    try:
+        if waited:
+            db = mongo.bioconductor_packages
+            packages = db.packages
+            state = packages.find_one(package_filter(name), {"state": 1})["state"]
+            if state in ("DONE", "FAILED"):
+                logger.info("Another worker built package %s, it is %s.", name, state)
+                return state == "DONE"
+
+        return build_claimed_package(name, prefix)
+    finally:
+        claims.release(name)
+
+
+def build_claimed_package(name, prefix="bioconductor-"):
+    db = mongo.bioconductor_packages
+    packages = db.packages
+
+    logger.info("Building package {0}.".format(name))
+    package_record = packages.find_one(package_filter(name))
+
+    # Check for packages that we can't build.
+    if package_record["state"] == "FAILED":
+        logger.info("Can't build package {}, it has failed in the past.".format(name))
+        return False
+
+    built_sibling = releases.find_built_sibling(package_record)
+    if built_sibling is not None:
+        logger.info("Package {0} {1} was already built for release {2}.".format(
+            name, package_record["version"], built_sibling["release"]))
+        releases.share_build_result(package_record)
+        return True
+
+    # Apply fixes learned from other packages' errors before the first build.
+    if package_record["state"] == "NEW" and not package_record.get("fixes_checked"):
+        if error_fixes.apply_known_fixes(package_record) > 0:
+            package_record = packages.find_one(package_filter(name))
+
+    full_package_name = render_recipe(package_record, prefix)
+
+    build_error = False
+
+    output_string, error_string = run_conda_build(name, full_package_name)
 
     build_error = catch_and_handle_errors(name, error_string, output_string)
 
     if build_error:
         logger.info("There was a build error for package {}.".format(name))
         logger.info(error_string)
-        packages.update_one(
-            {"name": name},
-            {"$set": {"state": "FAILED"}}
-        )
+        mark_failed(name,
+                    classify_build_error(error_string, output_string),
+                    failure_message=first_error_line(error_string))
         return False
     else:
         logger.info("There was no build error for package: {0}".format(name))
-        packages.update_one(
-            {"name": name},
-            {"$set": {"state": "DONE"}}
-        )
+        set_package_state(name, "DONE")
+        releases.share_build_result(package_record)
         return True
 
 
 def main():
-    # Reset log files
-    try:
-        os.remove("stderr.txt")
-    except OSError:
-        pass
-    try:
-        os.remove("stdout.txt")
-    except OSError:
-        pass
+    reset_logs()
 
     # Parse out the name arg
     parser = argparse.ArgumentParser(
         description='Generates a conda meta.yaml file.')
     parser.add_argument(
         '-n', '--name', help='The name of the conda package.', required=True)
+    parser.add_argument(
+        '-r', '--release', default=releases.DEFAULT_RELEASE,
+        help='The bioconductor release to build the package for.')
 
     args = vars(parser.parse_args())
     package_name = args["name"]
+    releases.set_current_release(args["release"])
+    releases.ensure_indexes()
+    releases.ensure_release_field()
 
     build_package_and_deps(package_name)
 
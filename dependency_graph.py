@@ -0,0 +1,197 @@
+"""Whole-catalog questions about package dependencies, answered without
+walking Mongo one document at a time.
+
+The catalog is loaded once into compressed sparse row (CSR) arrays: the
+dependencies of node i are indices[indptr[i]:indptr[i + 1]]. Queries are
+breadth first searches over those arrays, done with NumPy a whole
+frontier at a time, so they take milliseconds even for tens of thousands
+of packages.
+
+Dependencies which aren't in the catalog (like r-base) are nodes too,
+with a state of None."""
+
+import numpy as np
+from mongo_singleton import mongo
+import releases
+
+db = mongo.bioconductor_packages
+packages = db.packages
+
+
+def gather_neighbors(indptr, indices, nodes):
+    """Returns the concatenated neighbors of every node in nodes."""
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    # Offset of each neighbor within its node's slice of indices.
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return indices[np.repeat(starts, counts) + offsets]
+
+
+def reachable(indptr, indices, sources, stop=None):
+    """Returns a mask of the nodes reachable from the sources mask, including
+    the sources. Nodes in the stop mask are reached but not searched from."""
+    visited = sources.copy()
+    frontier = np.flatnonzero(sources)
+    while frontier.size > 0:
+        neighbors = np.unique(gather_neighbors(indptr, indices, frontier))
+        frontier = neighbors[~visited[neighbors]]
+        visited[frontier] = True
+        if stop is not None:
+            frontier = frontier[~stop[frontier]]
+    return visited
+
+
+def longest_path_levels(indptr, indices, reverse_indptr, reverse_indices):
+    """Returns the length of the longest path from each node to a node
+    without neighbors, or -1 for nodes which reach a cycle."""
+    node_count = len(indptr) - 1
+    levels = np.full(node_count, -1, dtype=np.int32)
+    remaining = np.diff(indptr).astype(np.int64)
+    frontier = np.flatnonzero(remaining == 0)
+    level = 0
+    while frontier.size > 0:
+        levels[frontier] = level
+        predecessors = gather_neighbors(reverse_indptr, reverse_indices, frontier)
+        remaining -= np.bincount(predecessors, minlength=node_count)
+        frontier = np.unique(predecessors)
+        frontier = frontier[remaining[frontier] == 0]
+        level += 1
+    return levels
+
+
+def build_csr(edge_sources, edge_targets, node_count):
+    order = np.lexsort((edge_targets, edge_sources))
+    indices = edge_targets[order]
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_sources, minlength=node_count), out=indptr[1:])
+    return indptr, indices
+
+
+class DependencyGraph(object):
+    def __init__(self, names, states, edge_sources, edge_targets):
+        self.names = names
+        self.node_ids = {name: i for i, name in enumerate(names)}
+        self.states = np.array(states, dtype=object)
+        node_count = len(names)
+        edge_sources = np.asarray(edge_sources, dtype=np.int32)
+        edge_targets = np.asarray(edge_targets, dtype=np.int32)
+        # Package -> its dependencies.
+        self.indptr, self.indices = build_csr(edge_sources, edge_targets, node_count)
+        # Dependency -> the packages which depend on it.
+        self.reverse_indptr, self.reverse_indices = build_csr(edge_targets, edge_sources,
+                                                              node_count)
+        self._levels = None
+
+    @classmethod
+    def from_records(cls, package_records):
+        """Builds the graph from package records with name, state and dependencies."""
+        names = []
+        states = []
+        node_ids = {}
+
+        def node_id(name, state=None):
+            if name not in node_ids:
+                node_ids[name] = len(names)
+                names.append(name)
+                states.append(state)
+            return node_ids[name]
+
+        dependency_lists = []
+        for package_record in package_records:
+            i = node_id(package_record["name"])
+            states[i] = package_record.get("state")
+            dependency_lists.append((i, package_record.get("dependencies", [])))
+
+        edges = set()
+        for i, dependencies in dependency_lists:
+            for dependency in dependencies:
+                # A dependency can be listed twice with different versions.
+                edges.add((i, node_id(dependency["name"])))
+
+        edges = sorted(edges)
+        return cls(names,
+                   states,
+                   [source for source, _ in edges],
+                   [target for _, target in edges])
+
+    @classmethod
+    def load(cls, release=releases.DEFAULT_RELEASE):
+        """Loads the catalog of release, including CRAN packages, from Mongo."""
+        projection = {"_id": 0, "name": 1, "state": 1, "dependencies.name": 1}
+        return cls.from_records(packages.find({"release": {"$in": [release, None]}}, projection))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _mask(self, names):
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[[self.node_ids[name] for name in names if name in self.node_ids]] = True
+        return mask
+
+    def _names(self, mask):
+        return [self.names[i] for i in np.flatnonzero(mask)]
+
+    def state_mask(self, *states):
+        return np.isin(self.states, list(states))
+
+    def dependencies_of(self, names):
+        """Returns every package the given packages depend on, transitively."""
+        sources = self._mask(names)
+        return self._names(reachable(self.indptr, self.indices, sources) & ~sources)
+
+    def dependents_of(self, names):
+        """Returns every package which depends on one of the given packages, transitively."""
+        sources = self._mask(names)
+        return self._names(reachable(self.reverse_indptr, self.reverse_indices, sources)
+                           & ~sources)
+
+    def transitively_blocked(self):
+        """Returns the unbuilt packages which can't be built because something
+        they depend on, directly or not, has failed. Packages which were built
+        anyway (e.g. the failed dependency resolved from conda-forge) don't
+        block the packages depending on them."""
+        failed = self.state_mask("FAILED")
+        done = self.state_mask("DONE")
+        blocked = reachable(self.reverse_indptr, self.reverse_indices, failed, stop=done)
+        return self._names(blocked & self.state_mask("NEW", "TRIED"))
+
+    def topological_levels(self):
+        """Returns each package's level: 0 for packages without dependencies,
+        otherwise one more than the level of its deepest dependency. Packages
+        which depend on a cycle have level -1."""
+        if self._levels is None:
+            self._levels = longest_path_levels(self.indptr, self.indices,
+                                               self.reverse_indptr, self.reverse_indices)
+        return dict(zip(self.names, self._levels.tolist()))
+
+    def longest_chain(self):
+        """Returns the longest chain of dependencies, starting with the package
+        which has to wait for the most sequential builds."""
+        self.topological_levels()
+        levels = self._levels
+        if len(levels) == 0 or levels.max() < 0:
+            return []
+
+        node = int(np.argmax(levels))
+        chain = [self.names[node]]
+        while levels[node] > 0:
+            dependencies = self.indices[self.indptr[node]:self.indptr[node + 1]]
+            node = int(dependencies[np.argmax(levels[dependencies] == levels[node] - 1)])
+            chain.append(self.names[node])
+        return chain
+
+    def cyclic(self):
+        """Returns the packages which lie on a dependency cycle, or on a path
+        between two cycles. Packages which only depend on a cycle, or are
+        only depended on by one, aren't included."""
+        self.topological_levels()
+        reverse_levels = longest_path_levels(self.reverse_indptr, self.reverse_indices,
+                                             self.indptr, self.indices)
+        return self._names((self._levels < 0) & (reverse_levels < 0))
+
+    def most_common_dependencies(self, limit=10):
+        """Returns (name, number of direct dependents) pairs for the dependencies
+        most packages list."""
+        counts = np.diff(self.reverse_indptr)
+        top = np.argsort(-counts, kind="stable")[:limit]
+        return [(self.names[i], int(counts[i])) for i in top if counts[i] > 0]
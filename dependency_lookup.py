@@ -1,4 +1,5 @@
 import requests
+import build_cache
 from mongo_singleton import mongo
 from pprint import pprint
 from cran_scraper import scrape_cran_package
@@ -28,39 +29,72 @@ def populate_lookup_table():
         {"r_name": "foreach", "conda_name": "r-foreach", "channel": "conda-forge"})
 
 
-def get_dependency_string(dep_object):
-    dep_name = dep_object["name"]
+def find_package_record(name):
+    """Returns the fields of a package record needed to resolve it as a dependency."""
+    package_record = build_cache.package_records.get(name)
+    if package_record is None:
+        package_record = packages.find_one({"name": name}, {"_id": 0, "name": 1, "source": 1})
+        if package_record is not None:
+            build_cache.package_records.set(name, package_record)
 
-    start_string = ""
-    end_string = ""
-    if "version" in dep_object:
-        # Only use single quotes if there's a version number
-        start_string = "'"
-        end_string = " >=" + dep_object["version"] + "'"
+    return package_record
 
-    # special case:
-    if dep_name == "r-base":
-        return start_string + "r-base" + end_string
 
+def resolve_conda_name(dep_name):
+    """Returns the conda package name for the R package dep_name. Resolutions
+    are cached, since finding one can take an HTTP request to anaconda.org."""
+    conda_name = build_cache.dependency_names.get(dep_name)
+    if conda_name is not None:
+        return conda_name
+
+    conda_name = _resolve_conda_name(dep_name)
+    if conda_name is not None:
+        build_cache.dependency_names.set(dep_name, conda_name)
+
+    return conda_name
+
+
+def _resolve_conda_name(dep_name):
     request = requests.get(ANACONDA_URL_BASE + dep_name)
     # Anaconda doesn't know how to use HTTP codes apparently, so this is the only
     # way to know we're not authenticated....
     if request.text.find("trying to access a page that requires authentication.") == -1:
-        return start_string + "r-" + dep_name.lower() + end_string
+        return "r-" + dep_name.lower()
 
     dep_lookup_entry = dep_lookup.find_one({"r_name": dep_name})
     if dep_lookup_entry is not None:
-        return start_string + dep_lookup_entry["conda_name"] + end_string
+        return dep_lookup_entry["conda_name"]
 
-    package_record = packages.find_one({"name": dep_name})
+    package_record = find_package_record(dep_name)
     if package_record is not None:
         if "source" in package_record and package_record["source"] == "cran":
-            return start_string + "r-" + dep_name.lower() + end_string
+            return "r-" + dep_name.lower()
         else:
-            return start_string + "bioconductor-" + dep_name.lower() + end_string
+            return "bioconductor-" + dep_name.lower()
 
     if scrape_cran_package(dep_name):
-        return start_string + "r-" + dep_name.lower() + end_string
+        return "r-" + dep_name.lower()
+
+    return None
+
+
+def get_dependency_string(dep_object):
+    dep_name = dep_object["name"]
+
+    start_string = ""
+    end_string = ""
+    if "version" in dep_object:
+        # Only use single quotes if there's a version number
+        start_string = "'"
+        end_string = " >=" + dep_object["version"] + "'"
+
+    # special case:
+    if dep_name == "r-base":
+        return start_string + "r-base" + end_string
+
+    conda_name = resolve_conda_name(dep_name)
+    if conda_name is not None:
+        return start_string + conda_name + end_string
 
     logger.error("Cannot find dependency:")
     pprint(dep_object)
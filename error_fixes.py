@@ -0,0 +1,182 @@
+"""Remembers the dependency version fixes made while handling build errors
+so they can be applied to other packages before their first build,
+instead of being rediscovered by another failed `conda build`. A fix is
+only remembered once the rebuild it was made for has succeeded.
+
+A fix is scoped either to a package (e.g. package X needs a newer R) or
+to a dependency (e.g. every package depending on Y needs a newer Y). It
+only applies to a package whose bound on the dependency is the same one
+the fix was learned from, or which doesn't list the dependency either if
+it wasn't listed then."""
+
+import threading
+from datetime import datetime
+from pymongo import ASCENDING
+from mongo_singleton import mongo
+from releases import package_filter
+
+# Import and set logger
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+PACKAGE_SCOPE = "package"
+DEPENDENCY_SCOPE = "dependency"
+
+db = mongo.bioconductor_packages
+packages = db.packages
+error_fixes = db.error_fixes
+metrics = db.error_fix_metrics
+
+# Name of the package being rebuilt -> the fixes made for that rebuild.
+pending_fixes = {}
+pending_lock = threading.Lock()
+
+
+def ensure_indexes():
+    error_fixes.create_index([("scope", ASCENDING), ("package", ASCENDING),
+                              ("dependency", ASCENDING), ("listed", ASCENDING),
+                              ("from_version", ASCENDING)])
+
+
+def is_listed(dependencies, dependency_name):
+    return any(dependency["name"] == dependency_name for dependency in dependencies)
+
+
+def version_bound(dependencies, dependency_name):
+    """Returns the version bound on dependency_name in a package's dependency
+    list, or None if it isn't versioned or listed at all. Handling errors can leave several
+    entries for the same dependency, the last versioned one wins."""
+    bound = None
+    for dependency in dependencies:
+        if dependency["name"] == dependency_name and "version" in dependency:
+            bound = dependency["version"]
+    return bound
+
+
+def increment_metrics(**counts):
+    metrics.update_one({"_id": "totals"}, {"$inc": counts}, upsert=True)
+
+
+def propose_fix(rebuilt_package, signature, package_name, dependency_name, to_version, scope):
+    """Notes that the error identified by signature is being fixed by making
+    package_name require dependency_name >= to_version, before rebuilding
+    rebuilt_package. Must be called before the fix is made, so the bound it
+    replaces can be read. The fix is remembered by `settle_fixes`."""
+    package_record = packages.find_one(package_filter(package_name))
+    listed = False
+    from_version = None
+    if package_record is not None:
+        listed = is_listed(package_record["dependencies"], dependency_name)
+        from_version = version_bound(package_record["dependencies"], dependency_name)
+
+    if not listed and scope == DEPENDENCY_SCOPE:
+        # The dependency was loaded indirectly. Whether another package does
+        # the same can't be told from its dependency list, so only this
+        # package is known to need the fix.
+        scope = PACKAGE_SCOPE
+
+    fix = {
+        "key": {
+            "scope": scope,
+            "package": package_name if scope == PACKAGE_SCOPE else None,
+            "dependency": dependency_name,
+            "listed": listed,
+            "from_version": from_version,
+        },
+        "to_version": to_version,
+        "signature": signature,
+    }
+    with pending_lock:
+        pending_fixes.setdefault(rebuilt_package, []).append(fix)
+
+
+def settle_fixes(rebuilt_package, rebuild_succeeded):
+    """Remembers the fixes proposed for rebuilt_package if rebuilding it
+    succeeded, and forgets them otherwise."""
+    with pending_lock:
+        fixes = pending_fixes.pop(rebuilt_package, [])
+
+    if not rebuild_succeeded:
+        if len(fixes) > 0:
+            logger.info("Rebuilding %s failed, not remembering the %d fixes made for it.",
+                        rebuilt_package, len(fixes))
+        return
+
+    for fix in fixes:
+        key = fix["key"]
+        error_fixes.update_one(
+            key,
+            {"$set": {"to_version": fix["to_version"],
+                      "signature": fix["signature"],
+                      "verified": True},
+             "$setOnInsert": {"learned_at": datetime.utcnow(), "times_applied": 0},
+             "$inc": {"times_learned": 1}},
+            upsert=True
+        )
+        increment_metrics(fixes_learned=1)
+        logger.info("Learned fix for %s: %s %s -> >=%s (%s scope).",
+                    fix["signature"], key["dependency"], key["from_version"],
+                    fix["to_version"], key["scope"])
+
+
+def apply_known_fixes(package_record):
+    """Applies every verified fix whose preconditions match package_record.
+    Returns how many fixes were applied."""
+    dependencies = package_record["dependencies"]
+    dependency_names = list(set(dependency["name"] for dependency in dependencies))
+    candidates = error_fixes.find({
+        "verified": True,
+        "$or": [
+            {"scope": PACKAGE_SCOPE, "package": package_record["name"]},
+            {"scope": DEPENDENCY_SCOPE, "dependency": {"$in": dependency_names}},
+        ],
+    })
+
+    applied = []
+    for fix in candidates:
+        dependency_name = fix["dependency"]
+        # Fixes learned before this was recorded were for listed dependencies.
+        listed = is_listed(dependencies, dependency_name)
+        if listed != fix.get("listed", True):
+            continue
+        if listed and version_bound(dependencies, dependency_name) != fix["from_version"]:
+            continue
+
+        dependencies = [d for d in dependencies if d["name"] != dependency_name]
+        dependencies.append({"name": dependency_name, "version": fix["to_version"]})
+        applied.append(fix["_id"])
+        logger.info("Applying known fix to %s: %s >=%s.",
+                    package_record["name"], dependency_name, fix["to_version"])
+
+    update = {"$set": {"fixes_checked": True}}
+    if len(applied) > 0:
+        update["$set"]["dependencies"] = dependencies
+        error_fixes.update_many({"_id": {"$in": applied}}, {"$inc": {"times_applied": 1}})
+
+    packages.update_one({"_id": package_record["_id"]}, update)
+    increment_metrics(packages_checked=1,
+                      packages_fixed=1 if len(applied) > 0 else 0,
+                      fixes_applied=len(applied))
+    return len(applied)
+
+
+def fix_cache_stats():
+    """Returns how often learned fixes were applied before a build. The hit
+    rate is the share of checked packages which had a fix applied, the
+    avoided rate is the share of fixes which didn't need a failed build."""
+    totals = metrics.find_one({"_id": "totals"}) or {}
+    checked = totals.get("packages_checked", 0)
+    fixed = totals.get("packages_fixed", 0)
+    applied = totals.get("fixes_applied", 0)
+    learned = totals.get("fixes_learned", 0)
+    return {
+        "known_fixes": error_fixes.count_documents({"verified": True}),
+        "packages_checked": checked,
+        "packages_fixed": fixed,
+        "fixes_applied": applied,
+        "fixes_learned": learned,
+        "hit_rate": fixed / checked if checked else 0.0,
+        "avoided_rate": applied / (applied + learned) if applied + learned else 0.0,
+    }
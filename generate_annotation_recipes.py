@@ -1,10 +1,21 @@
 """This script scrapes bioconductor.org for packages and inserts
-them into the bioconductor_packages.packages collection."""
+them into the bioconductor_packages.packages collection. Several
+releases can be scraped in one run, and a package version which was
+already scraped for another release reuses that release's record.
 
+With --incremental, packages which are already in the collection are
+only updated if their metadata changed, and package pages which haven't
+changed since the last run aren't downloaded again."""
+
+import argparse
+import itertools
+from datetime import datetime
 import requests
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, DESCENDING
 from pprint import pprint
-from lxml import etree
+import html_stream
+from releases import DEFAULT_RELEASE, ensure_indexes, ensure_release_field
 
 # Import and set logger
 import logging
@@ -16,69 +27,353 @@ logger = logging.getLogger(__name__)
 client = MongoClient()
 db = client.bioconductor_packages
 packages = db.packages
+http_cache = db.http_cache
 
 namespaces = ["bioc", "data/annotation", "data/experiment"]
 
-PACKAGE_LIST_URL = "https://bioconductor.org/packages/3.5/{namespace}/"
-PACKAGE_URL_TEMPLATE = "https://bioconductor.org/packages/3.5/{namespace}/html/{package_name}.html"
-SOURCE_URL_BASE = "https://bioconductor.org/packages/3.5/{namespace}/src/contrib"
-
-i = 0
-for namespace in namespaces:
-    html = requests.get(PACKAGE_LIST_URL.format(namespace=namespace)).text
-
-    table = etree.HTML(html).find(".//table")
-    rows = iter(table)
-    headers = [col.text for col in next(rows)]
-    table = []
-    for row in rows:
-        package_name = row[0].getchildren()[0].text
-        values = [col.text for col in row[1:]]
-        values = [package_name] + values
-        table.append(dict(zip(headers, values)))
-
-    for row in table:
+PACKAGE_LIST_URL = "https://bioconductor.org/packages/{release}/{namespace}/"
+PACKAGE_URL_TEMPLATE = ("https://bioconductor.org/packages/{release}/{namespace}"
+                        "/html/{package_name}.html")
+SOURCE_URL_BASE = "https://bioconductor.org/packages/{release}/{namespace}/src/contrib"
+
+# The fields of a package record which come from scraping its page.
+SCRAPED_FIELDS = ["version", "home_url", "source_url_base", "license_code", "summary",
+                  "maintainer"]
+# The scraped fields which are the same for a package version in every release.
+RELEASE_INDEPENDENT_FIELDS = ["version", "license_code", "summary", "maintainer"]
+
+
+def fetch_page(url, conditional=False):
+    """Returns the streamed response for url, or None if conditional is set
+    and the page hasn't changed since its validators were last remembered.
+    Raises requests.HTTPError if the page couldn't be fetched."""
+    headers = {}
+    if conditional:
+        validators = http_cache.find_one({"url": url})
+        if validators is not None:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = requests.get(url, headers=headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code != 200:
+        # An error page would otherwise be parsed as the package's page.
+        response.close()
+        raise requests.HTTPError("Fetching {} returned status {}.".format(
+            url, response.status_code), response=response)
+
+    return response
+
+
+def remember_validators(url, response):
+    """Stores the ETag and Last-Modified headers of the response for url. This should
+    only happen once the page has been processed, otherwise a failed run
+    would cause the page to be skipped from then on."""
+    http_cache.update_one(
+        {"url": url},
+        {"$set": {"etag": response.headers.get("ETag"),
+                  "last_modified": response.headers.get("Last-Modified")}},
+        upsert=True
+    )
+
+
+def iter_package_index(url):
+    """Yields a dict for each row of the first table on the package index
+    page at url, while the page is still downloading."""
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        headers = None
+        for element in html_stream.iter_elements(response, ("tr", "table")):
+            if element.tag == "table":
+                # Only the first table lists packages.
+                break
+
+            if headers is None:
+                headers = [col.text for col in element]
+            else:
+                package_name = element[0].getchildren()[0].text
+                values = [col.text for col in element[1:]]
+                values = [package_name] + values
+                yield dict(zip(headers, values))
+
+            html_stream.release(element)
+
+
+def parse_package_page(response):
+    previous_cell_text = None
+    version = None
+    license_code = None
+    paragraph_count = 0
+    summary_text = None
+    maintainer_text = ""
+    for element in html_stream.iter_elements(response, ("td", "p")):
+        if element.tag == "td":
+            # The value of a field is in the cell following its name.
+            if previous_cell_text == "Version":
+                version = element.text
+            elif previous_cell_text == "License":
+                license_code = element.text
+            previous_cell_text = element.text
+        else:
+            if paragraph_count == 4:
+                # brittle, but there's no way to identify it for sure.
+                summary_text = element.text
+            paragraph_count += 1
+
+            paragraph_text = element.text
+            if paragraph_text and "Maintainer" in paragraph_text:
+                maintainer_text = paragraph_text
+
+        html_stream.release(element)
+
+    if version is None or license_code is None:
+        raise ValueError("{} has no Version or License cell.".format(response.url))
+
+    return {
+        "version": version,
+        "license_code": license_code,
+        "summary": summary_text,
+        "maintainer": maintainer_text,
+    }
+
+
+def parse_packages_file(text):
+    """Parses a CRAN style PACKAGES file into a dict of package name to
+    its version and tarball md5."""
+    index = {}
+    for paragraph in text.split("\n\n"):
+        fields = {}
+        key = None
+        for line in paragraph.split("\n"):
+            if line[:1].isspace() and key is not None:
+                # Continuation of the previous field.
+                fields[key] += " " + line.strip()
+            elif ":" in line:
+                key, value = line.split(":", 1)
+                fields[key] = value.strip()
+
+        if "Package" in fields and "Version" in fields:
+            index[fields["Package"]] = {"version": fields["Version"],
+                                        "md5": fields.get("MD5sum")}
+
+    return index
+
+
+def fetch_packages_file(source_url_base):
+    response = requests.get(source_url_base + "/PACKAGES")
+    if response.status_code != 200:
+        logger.warning("Couldn't fetch the PACKAGES file from %s, packages shared"
+                       " with other releases will be scraped again.", source_url_base)
+        return {}
+
+    return parse_packages_file(response.text)
+
+
+def find_sibling(package_name, release, version):
+    """Returns the record of the same package version in another release, or None."""
+    return packages.find_one({"name": package_name,
+                              "version": version,
+                              "release": {"$nin": [release, None]}})
+
+
+def new_package_record(package_name, release, metadata, priority, sibling=None):
+    record = {
+        "name": package_name,
+        "lower_name": package_name.lower(),
+        "release": release,
+        "dependencies": [{"name": "r-base", "version": "3.3.2"}],
+        "priority": priority,
+        "state": "NEW",
+        "state_changed_at": datetime.utcnow()
+    }
+    if sibling is not None:
+        # Dependencies found while building the sibling apply to this record too.
+        record["dependencies"] = sibling["dependencies"]
+        if sibling["state"] == "DONE":
+            record["state"] = "DONE"
+
+    record.update(metadata)
+    return record
+
+
+def next_priority():
+    highest_priority_package = packages.find_one({}, sort=[("priority", DESCENDING)])
+    if highest_priority_package is None:
+        return 0
+    return highest_priority_package["priority"] + 1
+
+
+def reset_package_and_dependents(package_name, release):
+    """Sets the state of package_name, and every package in its release which
+    depends on it directly or transitively, back to NEW so that they get rebuilt."""
+    to_reset = {package_name}
+    frontier = [package_name]
+    while len(frontier) > 0:
+        dependents = packages.find({"dependencies.name": {"$in": frontier},
+                                    "release": {"$in": [release, None]}},
+                                   {"name": 1})
+        frontier = [dependent["name"] for dependent in dependents
+                    if dependent["name"] not in to_reset]
+        to_reset.update(frontier)
+
+    packages.update_many(
+        {"name": {"$in": list(to_reset)},
+         "release": {"$in": [release, None]},
+         "state": {"$ne": "NEW"}},
+        {"$set": {"state": "NEW", "state_changed_at": datetime.utcnow()},
+         "$unset": {"fixes_checked": "",
+                    "failure_cause": "",
+                    "failure_message": "",
+                    "blocked_by": ""}}
+    )
+    logger.info("Reset %d packages to NEW because %s changed version in release %s.",
+                len(to_reset), package_name, release)
+
+
+def sync_package(package_name, release, metadata, priorities, sibling=None):
+    """Upserts the scraped metadata for package_name. Returns True if the
+    stored record was created or changed."""
+    existing = packages.find_one({"name": package_name, "release": release})
+    if existing is None:
+        packages.insert_one(new_package_record(
+            package_name, release, metadata, next(priorities), sibling))
+        logger.info("Generated package: %s (%s)", package_name, release)
+        return True
+
+    changed = {field: metadata[field] for field in SCRAPED_FIELDS
+               if existing.get(field) != metadata[field]}
+    if len(changed) == 0:
+        return False
+
+    logger.info("Package %s (%s) changed:", package_name, release)
+    pprint(changed)
+    update = {"$set": changed}
+    if "md5" in metadata:
+        update["$set"]["md5"] = metadata["md5"]
+    elif "version" in changed:
+        update["$unset"] = {"md5": ""}
+    packages.update_one({"_id": existing["_id"]}, update)
+    if "version" in changed:
+        reset_package_and_dependents(package_name, release)
+
+    return True
+
+
+def scrape_namespace(release, namespace, incremental, priorities):
+    # The index doesn't list versions, so it has to be fetched every time
+    # to find out about new packages. The package pages are conditional.
+    index_url = PACKAGE_LIST_URL.format(release=release, namespace=namespace)
+    source_url_base = SOURCE_URL_BASE.format(release=release, namespace=namespace)
+    packages_file = fetch_packages_file(source_url_base)
+
+    changed_count = 0
+    reused_count = 0
+    for row in iter_package_index(index_url):
         package_name = row["Package"]
 
         # Too many packages to do them all at once, only doin pd.* for now.
         if package_name[0:3] != "pd.":
             continue
 
-        package_url = PACKAGE_URL_TEMPLATE.format(namespace=namespace, package_name=package_name)
-        package_html = requests.get(package_url).text
-        parsed_html = etree.HTML(package_html)
-        columns = parsed_html.findall(".//td")
-        version_column = None
-        license_column = None
-        for column in columns:
-            if column.text == "Version":
-                version_column = column
-            elif column.text == "License":
-                license_column = column
-
-        version = version_column.getnext().text
-        license_code = license_column.getnext().text
-
-        paragraphs = parsed_html.findall(".//p")
-        summary_text = paragraphs[4].text  # brittle, but there's no way to identify it for sure.
-        maintainer_text = ""
-        for paragraph in paragraphs:
-            paragraph_text = paragraph.text
-            if paragraph_text and "Maintainer" in paragraph_text:
-                maintainer_text = paragraph_text
+        package_url = PACKAGE_URL_TEMPLATE.format(
+            release=release, namespace=namespace, package_name=package_name)
+
+        # If another release ships the same version, reuse its metadata
+        # instead of downloading the package page again.
+        sibling = None
+        response = None
+        metadata = {}
+        if package_name in packages_file:
+            version = packages_file[package_name]["version"]
+            sibling = find_sibling(package_name, release, version)
+            if packages_file[package_name]["md5"] is not None:
+                metadata["md5"] = packages_file[package_name]["md5"]
+
+        if sibling is not None:
+            reused_count += 1
+            for field in RELEASE_INDEPENDENT_FIELDS:
+                metadata[field] = sibling[field]
+            if "md5" not in metadata and "md5" in sibling:
+                metadata["md5"] = sibling["md5"]
+        else:
+            # A page which hasn't changed can only be skipped if its record
+            # is still there, e.g. not dropped while http_cache was kept.
+            conditional = incremental and packages.find_one(
+                {"name": package_name, "release": release}, {"_id": 1}) is not None
+            response = fetch_page(package_url, conditional)
+            if response is None:
+                continue
+            with response:
+                page_metadata = parse_package_page(response)
+            if (package_name not in packages_file
+                    or packages_file[package_name]["version"] != page_metadata["version"]):
+                # The tarball hash is for a different version than the page.
+                metadata.pop("md5", None)
+            metadata.update(page_metadata)
+
+        metadata["home_url"] = package_url
+        metadata["source_url_base"] = source_url_base
+
+        if incremental:
+            if sync_package(package_name, release, metadata, priorities, sibling):
+                changed_count += 1
+            if response is not None:
+                remember_validators(package_url, response)
+        else:
+            packages.insert_one(new_package_record(
+                package_name, release, metadata, next(priorities), sibling))
+            logger.info("Generated package: %s (%s)", package_name, release)
+
+    logger.info("Reused %d packages from other releases in %s/%s.",
+                reused_count, release, namespace)
+    if incremental:
+        logger.info("%d packages changed in %s/%s.", changed_count, release, namespace)
+
+
+def scrape_releases_of_namespace(scrape_releases, namespace, incremental, priorities):
+    """Scrapes namespace for one release after another. Scraping them at
+    once would fetch every package at about the same time in each release,
+    before the other release's record exists to be reused."""
+    for release in scrape_releases:
+        scrape_namespace(release, namespace, incremental, priorities)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Scrapes bioconductor.org for packages.')
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Only fetch pages which changed and only update packages whose metadata changed.')
+    parser.add_argument(
+        '-r', '--release', action='append', dest='releases',
+        help='A bioconductor release to scrape, can be given several times.'
+             ' Defaults to {}.'.format(DEFAULT_RELEASE))
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4,
+        help='How many namespaces to scrape concurrently.')
+
+    args = vars(parser.parse_args())
+    scrape_releases = args["releases"] or [DEFAULT_RELEASE]
+    ensure_indexes()
+    ensure_release_field()
+
+    if args["incremental"]:
+        priorities = itertools.count(next_priority())
+    else:
+        priorities = itertools.count()
+
+    with ThreadPoolExecutor(max_workers=args["workers"]) as executor:
+        futures = [executor.submit(scrape_releases_of_namespace, scrape_releases, namespace,
+                                   args["incremental"], priorities)
+                   for namespace in namespaces]
+        for future in futures:
+            # Re-raises any exception from the scraping thread.
+            future.result()
+
 
-        packages.insert_one({
-            "name": package_name,
-            "lower_name": package_name.lower(),
-            "version": version,
-            "home_url": package_url,
-            "source_url_base": SOURCE_URL_BASE.format(namespace=namespace),
-            "license_code": license_code,
-            "summary": summary_text,
-            "dependencies": [{"name": "r-base", "version": "3.3.2"}],
-            "priority": i,
-            "maintainer": maintainer_text,
-            "state": "NEW"
-        })
-        i += 1
-        logger.info("Generated package:" + package_name)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""Helpers for parsing HTML pages while they download, so the scrapers
+never hold a whole page, or its parsed tree, in memory."""
+
+from lxml import etree
+
+CHUNK_SIZE = 16 * 1024
+
+
+def iter_elements(response, tags):
+    """Yields every element with one of the given tags from a streamed
+    (stream=True) requests response, as soon as the element is closed.
+    Callers should `release` each element once they're done with it."""
+    parser = etree.HTMLPullParser(events=("end",), tag=tags, encoding=response.encoding)
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            yield element
+
+    parser.close()
+    for _, element in parser.read_events():
+        yield element
+
+
+def release(element):
+    """Frees an element which has been processed, along with the siblings
+    before it, which would otherwise be kept alive by their parent."""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
@@ -38,13 +38,17 @@ def generate_meta_yaml(
         license_type,
         summary,
         dependencies=[],
-        prefix="bioconductor-"
+        prefix="bioconductor-",
+        md5=None
 ):
+    """Writes the meta.yaml for a package and returns the md5 of its source
+    tarball. The tarball is only downloaded if md5 isn't already known."""
     full_file = name + "_" + version + ".tar.gz"
     full_package_name = prefix + name.lower()
 
     url = os.path.join(base_url, full_file)
-    md5 = hashlib.md5(urlopen(url).read()).hexdigest()
+    if md5 is None:
+        md5 = hashlib.md5(urlopen(url).read()).hexdigest()
 
     dep_text = ""
     for dep in dependencies:
@@ -66,3 +70,5 @@ def generate_meta_yaml(
 
     with open("recipes/{}/meta.yaml".format(full_package_name), "w") as yml_file:
         yml_file.write(text)
+
+    return md5
@@ -0,0 +1,86 @@
+"""Bioconductor packages are scraped per release, so every bioconductor
+package record has a "release" field. CRAN packages aren't tied to a
+release and have no such field, so they match every release.
+
+The same version of a package is often shipped by several releases. The
+helpers here let those records share work: once one of them is built (or
+its tarball hashed) the others reuse the result."""
+
+from datetime import datetime
+from pymongo import ASCENDING
+from mongo_singleton import mongo
+
+# Import and set logger
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RELEASE = "3.5"
+
+current_release = DEFAULT_RELEASE
+
+db = mongo.bioconductor_packages
+packages = db.packages
+
+
+def set_current_release(release):
+    global current_release
+    current_release = release
+
+
+def ensure_indexes():
+    packages.create_index([("name", ASCENDING), ("release", ASCENDING)])
+    packages.create_index([("state", ASCENDING), ("release", ASCENDING)])
+    packages.create_index([("state_changed_at", ASCENDING)])
+
+
+def ensure_release_field():
+    """Records scraped before releases were tracked have no release field,
+    and would otherwise match every release like CRAN records do. They were
+    all scraped from DEFAULT_RELEASE."""
+    result = packages.update_many(
+        {"release": {"$exists": False}, "source": {"$ne": "cran"}},
+        {"$set": {"release": DEFAULT_RELEASE}}
+    )
+    if result.modified_count > 0:
+        logger.info("Set the release of %d old package records to %s.",
+                    result.modified_count, DEFAULT_RELEASE)
+
+
+def package_filter(value, field="name"):
+    """Returns a query for the package whose field equals value in the current release."""
+    return {field: value, "release": {"$in": [current_release, None]}}
+
+
+def identical_packages_filter(package_record):
+    """Returns a query for every record of the same package version, in any release."""
+    return {"name": package_record["name"], "version": package_record["version"]}
+
+
+def find_built_sibling(package_record):
+    """Returns a record of the same package version in another release
+    which has already been built, or None."""
+    if package_record.get("release") is None:
+        return None
+
+    query = identical_packages_filter(package_record)
+    query["release"] = {"$nin": [package_record["release"], None]}
+    query["state"] = "DONE"
+    return packages.find_one(query)
+
+
+def share_build_result(package_record):
+    """Marks unbuilt records of the same package version as built."""
+    query = identical_packages_filter(package_record)
+    query["state"] = "NEW"
+    packages.update_many(
+        query,
+        {"$set": {"state": "DONE", "state_changed_at": datetime.utcnow()}}
+    )
+
+
+def share_md5(package_record, md5):
+    query = identical_packages_filter(package_record)
+    query["md5"] = {"$exists": False}
+    packages.update_many(query, {"$set": {"md5": md5}})
@@ -0,0 +1,200 @@
+"""Reports on the progress of building a release. Everything is computed
+with aggregation pipelines so that only the report itself, not every
+package document, is sent over the wire. It never writes to Mongo; the
+indexes the report relies on are created by the scraper and the build
+scripts."""
+
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+from mongo_singleton import mongo
+import releases
+import error_fixes
+from dependency_graph import DependencyGraph
+
+db = mongo.bioconductor_packages
+packages = db.packages
+
+UNBUILT_STATES = ["NEW", "TRIED", "FAILED"]
+
+
+def release_match(release, **conditions):
+    conditions["release"] = {"$in": [release, None]}
+    return {"$match": conditions}
+
+
+def count_states(release):
+    pipeline = [
+        release_match(release),
+        {"$group": {"_id": "$state", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+    ]
+    return {row["_id"]: row["count"] for row in packages.aggregate(pipeline)}
+
+
+def count_failure_causes(release):
+    pipeline = [
+        release_match(release, state="FAILED"),
+        {"$group": {"_id": {"$ifNull": ["$failure_cause", "unknown"]},
+                    "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+    ]
+    return {row["_id"]: row["count"] for row in packages.aggregate(pipeline)}
+
+
+def top_blocking_dependencies(release, limit):
+    """Returns the failed packages which the most unbuilt packages depend on."""
+    pipeline = [
+        release_match(release, state={"$in": UNBUILT_STATES}),
+        {"$unwind": "$dependencies"},
+        {"$group": {"_id": "$dependencies.name", "blocked": {"$sum": 1}}},
+        {"$lookup": {
+            "from": packages.name,
+            "let": {"dependency": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$name", "$$dependency"]},
+                            "release": {"$in": [release, None]},
+                            "state": "FAILED"}},
+                {"$project": {"_id": 0, "failure_cause": 1}},
+            ],
+            "as": "failed",
+        }},
+        {"$match": {"failed": {"$ne": []}}},
+        {"$sort": {"blocked": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0,
+                      "name": "$_id",
+                      "blocked": 1,
+                      "failure_cause": {"$arrayElemAt": ["$failed.failure_cause", 0]}}},
+    ]
+    return list(packages.aggregate(pipeline))
+
+
+def throughput(release, since):
+    """Returns how many packages finished building or failed per hour."""
+    pipeline = [
+        release_match(release,
+                      state={"$in": ["DONE", "FAILED"]},
+                      state_changed_at={"$gte": since}),
+        {"$group": {
+            "_id": {"hour": {"$dateToString": {"format": "%Y-%m-%d %H:00",
+                                               "date": "$state_changed_at"}},
+                    "state": "$state"},
+            "count": {"$sum": 1},
+        }},
+        {"$group": {
+            "_id": "$_id.hour",
+            "states": {"$push": {"k": "$_id.state", "v": "$count"}},
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "hour": "$_id", "states": {"$arrayToObject": "$states"}}},
+    ]
+    return list(packages.aggregate(pipeline))
+
+
+def graph_report(release, limit):
+    """Summarizes the dependency graph. Unlike the rest of the report this
+    loads the names and dependencies of every package once."""
+    graph = DependencyGraph.load(release)
+    return {
+        "transitively_blocked": len(graph.transitively_blocked()),
+        "longest_chain": graph.longest_chain(),
+        "cyclic": graph.cyclic(),
+        "most_common_dependencies": [{"name": name, "dependents": count} for name, count
+                                     in graph.most_common_dependencies(limit)],
+    }
+
+
+def build_report(release, hours, limit, include_graph=False):
+    start = time.time()
+    since = datetime.utcnow() - timedelta(hours=hours)
+    report = {
+        "release": release,
+        "states": count_states(release),
+        "failure_causes": count_failure_causes(release),
+        "blocking_dependencies": top_blocking_dependencies(release, limit),
+        "throughput": throughput(release, since),
+        "error_fixes": error_fixes.fix_cache_stats(),
+    }
+    if include_graph:
+        report["graph"] = graph_report(release, limit)
+    report["seconds"] = round(time.time() - start, 3)
+    return report
+
+
+def print_report(report):
+    print("Release {}".format(report["release"]))
+
+    print("\nPackages by state:")
+    for state, count in report["states"].items():
+        print("  {:<10} {:>7}".format(str(state), count))
+
+    print("\nFailure causes:")
+    for cause, count in report["failure_causes"].items():
+        print("  {:<24} {:>7}".format(cause, count))
+
+    print("\nFailed dependencies blocking the most packages:")
+    for dependency in report["blocking_dependencies"]:
+        print("  {:<32} {:>7}  ({})".format(dependency["name"],
+                                           dependency["blocked"],
+                                           dependency.get("failure_cause", "unknown")))
+
+    print("\nFinished per hour:")
+    for row in report["throughput"]:
+        print("  {}  done: {:>5}  failed: {:>5}".format(row["hour"],
+                                                      row["states"].get("DONE", 0),
+                                                      row["states"].get("FAILED", 0)))
+
+    fixes = report["error_fixes"]
+    print("\nLearned error fixes:")
+    print("  {} known, applied {} times to {} of {} packages checked (hit rate {:.1%}).".format(
+        fixes["known_fixes"], fixes["fixes_applied"], fixes["packages_fixed"],
+        fixes["packages_checked"], fixes["hit_rate"]))
+    print("  {:.1%} of fixes were applied without a failed build.".format(
+        fixes["avoided_rate"]))
+
+    if "graph" in report:
+        graph = report["graph"]
+        print("\nDependency graph:")
+        print("  {} packages are blocked by a failed dependency.".format(
+            graph["transitively_blocked"]))
+        print("  Longest build chain ({} packages): {}".format(
+            len(graph["longest_chain"]), " -> ".join(graph["longest_chain"])))
+        print("  {} packages are in dependency cycles.".format(len(graph["cyclic"])))
+        print("  Most common dependencies:")
+        for dependency in graph["most_common_dependencies"]:
+            print("    {:<32} {:>7}".format(dependency["name"], dependency["dependents"]))
+
+    print("\nComputed in {} seconds.".format(report["seconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reports on the progress of building a release.')
+    parser.add_argument(
+        '-r', '--release', default=releases.DEFAULT_RELEASE,
+        help='The bioconductor release to report on.')
+    parser.add_argument(
+        '--hours', type=int, default=24,
+        help='How many hours of throughput to report.')
+    parser.add_argument(
+        '--limit', type=int, default=10,
+        help='How many blocking dependencies to report.')
+    parser.add_argument(
+        '--json', action='store_true', help='Print the report as JSON.')
+    parser.add_argument(
+        '--graph', action='store_true',
+        help='Also analyze the dependency graph: blocked packages, build chains and cycles.')
+
+    args = vars(parser.parse_args())
+    report = build_report(args["release"], args["hours"], args["limit"], args["graph"])
+
+    if args["json"]:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()